@@ -1,34 +1,89 @@
 import sqlite3
+import asyncio
 import hashlib
-import uuid
-import json
+import hmac
+import secrets
+import orjson
 import logging
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, WebSocket, HTTPException
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Dict
+from pydantic import BaseModel, Field
+from typing import Dict, NamedTuple, Set, Tuple
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Инициализация приложения
-app = FastAPI(title="Voice Call App")
+# База данных
+DB_PATH = 'users.db'
+DB_POOL_SIZE = 4
 
-# CORS для разработки
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+def open_connection() -> sqlite3.Connection:
+    # Соединения живут долго и используются из потоков asyncio.to_thread
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    return conn
+
+# Небольшой пул долгоживущих соединений поверх asyncio.Queue
+class ConnectionPool:
+    def __init__(self, size: int):
+        self.size = size
+        self.is_open = False
+        self._queue: asyncio.Queue[sqlite3.Connection] = asyncio.Queue()
+
+    def open(self):
+        for _ in range(self.size):
+            self._queue.put_nowait(open_connection())
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+        while not self._queue.empty():
+            self._queue.get_nowait().close()
+
+    async def run(self, func, *args):
+        # Выполняет func(conn, *args) в потоке на соединении из пула
+        if not self.is_open:
+            raise RuntimeError("Пул соединений с БД не открыт (lifespan не запущен)")
+        conn = await self._queue.get()
+        task = asyncio.ensure_future(asyncio.to_thread(func, conn, *args))
+        # Соединение возвращается в пул, только когда поток действительно
+        # закончил работу: при отмене ожидающей корутины поток продолжает
+        # выполняться, и отдавать соединение второму потоку нельзя
+        task.add_done_callback(lambda done: self._release(conn, done))
+        return await asyncio.shield(task)
+
+    def _release(self, conn: sqlite3.Connection, task: asyncio.Future):
+        if not task.cancelled():
+            task.exception()  # помечаем ошибку полученной, даже если ожидающий был отменён
+        if not self.is_open:
+            # Пул закрыли, пока поток работал: соединение больше не нужно
+            conn.close()
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        self._queue.put_nowait(conn)
+
+def db_fetchone(conn: sqlite3.Connection, sql: str, params: tuple = ()):
+    return conn.execute(sql, params).fetchone()
+
+def db_execute(conn: sqlite3.Connection, sql: str, params: tuple = ()):
+    conn.execute(sql, params)
+    conn.commit()
+
+db_pool = ConnectionPool(DB_POOL_SIZE)
 
 # Инициализация базы данных
 def init_db():
-    conn = sqlite3.connect('users.db')
+    conn = open_connection()
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -38,76 +93,158 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    # Явный индекс для поиска по имени (дублирует неявный индекс UNIQUE)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
     conn.commit()
     conn.close()
 
 init_db()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    db_pool.open()
+    yield
+    db_pool.close()
+
+# Инициализация приложения
+app = FastAPI(title="Voice Call App", lifespan=lifespan)
+
+# CORS для разработки
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
 # Модели
 class UserCreate(BaseModel):
-    username: str
-    password: str
+    username: str = Field(min_length=3, max_length=20)
+    password: str = Field(min_length=4, max_length=256)
 
 class UserLogin(BaseModel):
     username: str
     password: str
 
-# Хэширование пароля
+# Хэширование пароля: Argon2id, 46 MiB, t=2, p=1 (память как в профиле OWASP,
+# но t поднят с 1 до 2 намеренно, для запаса стойкости)
+ph = PasswordHasher(time_cost=2, memory_cost=46 * 1024, parallelism=1)
+
 def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+    return ph.hash(password)
+
+def verify_password(stored_hash: str, password: str) -> bool:
+    # Старые записи хранят несолёный SHA-256
+    if not stored_hash.startswith("$argon2"):
+        return hmac.compare_digest(stored_hash, hashlib.sha256(password.encode()).hexdigest())
+    try:
+        return ph.verify(stored_hash, password)
+    except (VerifyMismatchError, InvalidHashError):
+        return False
+
+def needs_rehash(stored_hash: str) -> bool:
+    if not stored_hash.startswith("$argon2"):
+        return True
+    return ph.check_needs_rehash(stored_hash)
 
 # Хранилище сессий
 active_connections: Dict[str, WebSocket] = {}
 user_sessions: Dict[str, int] = {}  # session_id -> user_id
 user_names: Dict[int, str] = {}     # user_id -> username
+session_by_user: Dict[int, str] = {}  # user_id -> session_id (последнее подключение)
+user_connections: Dict[int, Set[str]] = {}  # user_id -> подключённые session_id (вкладки)
+
+BROADCAST_BATCH_SIZE = 50
+
+def dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
+
+# Постоянные сообщения сериализуются один раз
+USER_GONE = dumps({
+    "type": "error",
+    "message": "Пользователь не найден или отключился"
+})
+CALL_ENDED = dumps({"type": "call_ended"})
+
+# Маршруты сигнальных сообщений: входящий тип -> как переслать его собеседнику
+class SignalRoute(NamedTuple):
+    out_type: str                               # тип пересылаемого сообщения
+    fields: Tuple[str, ...]                     # поля, копируемые из входящего
+    sender_fields: Tuple[Tuple[str, str], ...] = ()  # (ключ, "user_id" | "username")
+    notify_missing: bool = False                # ошибка, если собеседник не в сети
+    preset: str | None = None                   # готовое сообщение без переменных полей
+
+    def encode(self, sender: Dict[str, object], message: dict) -> str:
+        if self.preset is not None:
+            return self.preset
+        outgoing = {"type": self.out_type}
+        for key, attr in self.sender_fields:
+            outgoing[key] = sender[attr]
+        for field in self.fields:
+            outgoing[field] = message[field]
+        return dumps(outgoing)
+
+SIGNALING_ROUTES: Dict[str, SignalRoute] = {
+    "call_user": SignalRoute(
+        "incoming_call", ("offer",),
+        sender_fields=(("from_user_id", "user_id"), ("from_username", "username")),
+        notify_missing=True,
+    ),
+    "answer_call": SignalRoute("call_answered", ("answer",)),
+    "ice_candidate": SignalRoute("ice_candidate", ("candidate",)),
+    "call_declined": SignalRoute("call_declined", (), sender_fields=(("by", "user_id"),)),
+    "call_ended": SignalRoute("call_ended", (), preset=CALL_ENDED),
+}
 
 # Маршруты API
 @app.post("/register")
 async def register(user: UserCreate):
-    # Валидация
-    if len(user.username) < 3:
-        raise HTTPException(status_code=400, detail="Имя должно быть не менее 3 символов")
-    if len(user.username) > 20:
-        raise HTTPException(status_code=400, detail="Имя должно быть не более 20 символов")
-    if len(user.password) < 4:
-        raise HTTPException(status_code=400, detail="Пароль должен быть не менее 4 символов")
-    
     # Проверка существования пользователя
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM users WHERE username = ?", (user.username,))
-    if cursor.fetchone():
-        conn.close()
+    existing = await db_pool.run(
+        db_fetchone, "SELECT id FROM users WHERE username = ?", (user.username,)
+    )
+    if existing:
         raise HTTPException(status_code=400, detail="Пользователь с таким именем уже существует")
     
-    # Создание пользователя
-    cursor.execute(
-        "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-        (user.username, hash_password(user.password))
-    )
-    conn.commit()
-    conn.close()
+    # Создание пользователя (хэширование в потоке, чтобы не блокировать event loop)
+    password_hash = await asyncio.to_thread(hash_password, user.password)
+    try:
+        await db_pool.run(
+            db_execute,
+            "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+            (user.username, password_hash)
+        )
+    except sqlite3.IntegrityError:
+        # Имя заняли параллельным запросом, пока шло хэширование
+        raise HTTPException(status_code=400, detail="Пользователь с таким именем уже существует")
     
     return {"message": "Регистрация успешна"}
 
 @app.post("/login")
 async def login(user: UserLogin):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, username, password_hash FROM users WHERE username = ?",
+    result = await db_pool.run(
+        db_fetchone,
+        "SELECT id, password_hash FROM users WHERE username = ?",
         (user.username,)
     )
-    result = cursor.fetchone()
-    conn.close()
     
-    if not result or result[2] != hash_password(user.password):
+    if not result or not await asyncio.to_thread(verify_password, result[1], user.password):
         raise HTTPException(status_code=401, detail="Неверное имя или пароль")
     
+    # Обновление устаревшего хэша
+    if needs_rehash(result[1]):
+        password_hash = await asyncio.to_thread(hash_password, user.password)
+        await db_pool.run(
+            db_execute,
+            "UPDATE users SET password_hash = ? WHERE id = ?",
+            (password_hash, result[0])
+        )
+    
     # Создание сессии
-    session_id = str(uuid.uuid4())
+    session_id = secrets.token_urlsafe(16)
     user_id = result[0]
-    username = result[1]
+    username = user.username
     
     user_sessions[session_id] = user_id
     user_names[user_id] = username
@@ -117,10 +254,13 @@ async def login(user: UserLogin):
 # Статические файлы
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# Главная страница читается с диска один раз при запуске
+with open("static/index.html", "rb") as f:
+    INDEX_HTML = f.read()
+
 @app.get("/")
 async def get():
-    with open("static/index.html") as f:
-        return HTMLResponse(f.read())
+    return HTMLResponse(INDEX_HTML)
 
 # WebSocket
 @app.websocket("/ws/{session_id}")
@@ -134,120 +274,140 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
     username = user_names.get(user_id, f"User_{user_id}")
     
     await websocket.accept()
-    active_connections[session_id] = websocket
+    register_connection(session_id, user_id, websocket)
     
     logger.info(f"Пользователь {username} (ID: {user_id}) подключился")
     await broadcast_online_users()
     
+    sender = {"user_id": user_id, "username": username}
+    
     try:
-        while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+        async for data in websocket.iter_text():
+            message = orjson.loads(data)
             msg_type = message.get("type")
+            route = SIGNALING_ROUTES.get(msg_type)
+            if route is None:
+                continue
             
-            if msg_type == "call_user":
-                target_user_id = message["target_user_id"]
-                target_session = find_user_session(target_user_id)
-                
-                if target_session:
-                    await active_connections[target_session].send_text(
-                        json.dumps({
-                            "type": "incoming_call",
-                            "from_user_id": user_id,
-                            "from_username": username,
-                            "offer": message["offer"]
-                        })
-                    )
-                else:
-                    await websocket.send_text(
-                        json.dumps({
-                            "type": "error",
-                            "message": "Пользователь не найден или отключился"
-                        })
-                    )
-            
-            elif msg_type == "answer_call":
-                target_user_id = message["target_user_id"]
-                target_session = find_user_session(target_user_id)
-                
-                if target_session:
-                    await active_connections[target_session].send_text(
-                        json.dumps({
-                            "type": "call_answered",
-                            "answer": message["answer"]
-                        })
-                    )
+            target_user_id = message.get("target_user_id")
+            if type(target_user_id) is not int:
+                continue
             
-            elif msg_type == "ice_candidate":
-                target_user_id = message["target_user_id"]
-                target_session = find_user_session(target_user_id)
-                
-                if target_session:
-                    await active_connections[target_session].send_text(
-                        json.dumps({
-                            "type": "ice_candidate",
-                            "candidate": message["candidate"]
-                        })
-                    )
+            try:
+                payload = route.encode(sender, message)
+            except KeyError:
+                # В сообщении нет обязательного поля (offer/answer/candidate)
+                continue
             
-            elif msg_type == "call_declined":
-                target_user_id = message["target_user_id"]
-                target_session = find_user_session(target_user_id)
-                
-                if target_session:
-                    await active_connections[target_session].send_text(
-                        json.dumps({
-                            "type": "call_declined",
-                            "by": user_id
-                        })
-                    )
-            
-            elif msg_type == "call_ended":
-                target_user_id = message["target_user_id"]
-                target_session = find_user_session(target_user_id)
-                
-                if target_session:
-                    await active_connections[target_session].send_text(
-                        json.dumps({
-                            "type": "call_ended"
-                        })
-                    )
+            delivered = False
+            peer = find_peer_ws(target_user_id)
+            while peer and not delivered:
+                try:
+                    await peer.send_text(payload)
+                    delivered = True
+                except Exception:
+                    # Сокет собеседника уже закрыт (uvicorn поднимает ClientDisconnected,
+                    # Starlette — RuntimeError): убираем его, а не рвём своё
+                    # соединение, и пробуем другую вкладку собеседника
+                    await drop_connection(session_by_user.get(target_user_id), peer)
+                    peer = find_peer_ws(target_user_id)
+            if not delivered and route.notify_missing:
+                await websocket.send_text(USER_GONE)
     
-    except WebSocketDisconnect:
+    finally:
+        # iter_text завершается при отключении; очистка нужна и при ошибках
         logger.info(f"Пользователь {username} (ID: {user_id}) отключился")
-        if session_id in active_connections:
-            del active_connections[session_id]
-        if session_id in user_sessions:
-            del user_sessions[session_id]
-        if user_id in user_names:
-            del user_names[user_id]
+        unregister_connection(session_id, user_id)
         await broadcast_online_users()
 
 # Вспомогательные функции
-def find_user_session(user_id: int) -> str | None:
-    for session_id, uid in user_sessions.items():
-        if uid == user_id and session_id in active_connections:
-            return session_id
-    return None
+
+# Реестр соединений меняется только синхронно, без await внутри. В одном
+# event loop такие функции атомарны относительно других корутин, поэтому
+# отдельная блокировка не нужна; обход реестра с await делается по снимку.
+def register_connection(session_id: str, user_id: int, websocket: WebSocket):
+    active_connections[session_id] = websocket
+    session_by_user[user_id] = session_id
+    user_connections.setdefault(user_id, set()).add(session_id)
+
+def discard_connection(session_id: str | None, websocket: WebSocket) -> bool:
+    # Убираем сокет, если под этой сессией не зарегистрирован уже другой.
+    # Сама сессия остаётся в user_connections до unregister_connection
+    if not session_id or active_connections.get(session_id) is not websocket:
+        return False
+    del active_connections[session_id]
+    user_id = user_sessions.get(session_id)
+    if user_id is not None:
+        repoint_session(user_id, session_id)
+    return True
+
+def repoint_session(user_id: int, closed_session_id: str):
+    # Если индекс указывал на закрытую сессию, переводим его на другую живую вкладку
+    if session_by_user.get(user_id) != closed_session_id:
+        return
+    for other in user_connections.get(user_id, ()):
+        if other != closed_session_id and other in active_connections:
+            session_by_user[user_id] = other
+            return
+    del session_by_user[user_id]
+
+def unregister_connection(session_id: str, user_id: int):
+    if session_id in active_connections:
+        del active_connections[session_id]
+    if session_id in user_sessions:
+        del user_sessions[session_id]
+    # Пользователь остаётся онлайн, пока открыта хотя бы одна его вкладка
+    sessions = user_connections.get(user_id, set())
+    sessions.discard(session_id)
+    if not sessions:
+        user_connections.pop(user_id, None)
+    repoint_session(user_id, session_id)
+
+async def drop_connection(session_id: str | None, websocket: WebSocket):
+    # Реестр чистится синхронно, затем сокет закрывается; его обработчик
+    # завершит iter_text и выполнит unregister_connection
+    if discard_connection(session_id, websocket):
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+def find_peer_ws(user_id: int) -> WebSocket | None:
+    session_id = session_by_user.get(user_id)
+    websocket = active_connections.get(session_id) if session_id else None
+    if websocket is None:
+        # Индекс указывает на закрытую вкладку: пробуем другую живую сессию
+        for other in user_connections.get(user_id, ()):
+            websocket = active_connections.get(other)
+            if websocket is not None:
+                session_by_user[user_id] = other
+                break
+    return websocket
 
 async def broadcast_online_users():
     online_users = [
-        {"user_id": uid, "username": uname}
-        for uid, uname in user_names.items()
+        {"user_id": uid, "username": user_names.get(uid, f"User_{uid}")}
+        for uid in list(user_connections)
     ]
     
-    for session_id, websocket in active_connections.items():
-        try:
-            user_id = user_sessions.get(session_id)
-            await websocket.send_text(
-                json.dumps({
-                    "type": "online_users",
-                    "users": online_users,
-                    "current_user_id": user_id
-                })
-            )
-        except:
-            pass
+    # Сериализуем один раз: сообщение одинаково для всех клиентов
+    payload = dumps({"type": "online_users", "users": online_users})
+    
+    # Отправляем пачками параллельно: медленный клиент не задерживает остальных,
+    # а между пачками отдаём управление event loop
+    connections = list(active_connections.items())
+    for start in range(0, len(connections), BROADCAST_BATCH_SIZE):
+        batch = connections[start:start + BROADCAST_BATCH_SIZE]
+        results = await asyncio.gather(
+            *(websocket.send_text(payload) for _, websocket in batch),
+            return_exceptions=True
+        )
+        await asyncio.gather(*(
+            drop_connection(session_id, websocket)
+            for (session_id, websocket), result in zip(batch, results)
+            if isinstance(result, Exception)
+        ))
+        await asyncio.sleep(0)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,63 @@
+import asyncio
+import importlib
+import json
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+from uvicorn.protocols.utils import ClientDisconnected
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    # main.py создаёт users.db и читает static/index.html из текущего каталога
+    shutil.copytree(ROOT / "static", tmp_path / "static")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(ROOT))
+    sys.modules.pop("main", None)
+    return importlib.import_module("main")
+
+
+class FakeWebSocket:
+    def __init__(self, frames=(), fail_after=None):
+        self.frames = list(frames)
+        self.fail_after = fail_after  # сколько отправок проходит до обрыва
+        self.sent = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def close(self, code=1000):
+        self.closed = True
+
+    async def send_text(self, data):
+        if self.fail_after is not None and len(self.sent) >= self.fail_after:
+            raise ClientDisconnected()
+        self.sent.append(json.loads(data))
+
+    async def iter_text(self):
+        for frame in self.frames:
+            yield json.dumps(frame)
+
+
+def test_dead_peer_does_not_kill_sender(main):
+    main.user_sessions.update({"alice": 1, "bob": 2})
+    main.user_names.update({1: "alice", 2: "bob"})
+
+    # Первая отправка (online_users) проходит, следующая падает как у uvicorn
+    peer = FakeWebSocket(fail_after=1)
+    main.register_connection("bob", 2, peer)
+
+    sender = FakeWebSocket(frames=[
+        {"type": "call_user", "target_user_id": 2, "offer": {"sdp": "x"}},
+    ])
+    asyncio.run(main.websocket_endpoint(sender, "alice"))
+
+    assert {"type": "error", "message": "Пользователь не найден или отключился"} in sender.sent
+    assert peer.closed
+    assert "bob" not in main.active_connections
+    assert 2 not in main.session_by_user